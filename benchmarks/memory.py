@@ -0,0 +1,65 @@
+'''Measure the peak memory used to parse a large .lxl file.
+
+Generates a document with sections full of prose, equations, lists
+and theorems, parses it (without writing anything, so LaTeXML isn't
+needed) and reports how much the peak RSS grew, per 1,000 lines.
+
+    python benchmarks/memory.py [--sections 200] [--lxl path/to/lxl.py]
+
+Use --lxl to measure another version of lxl.py, e.g. one from
+git show <commit>:lxl.py > /tmp/old_lxl.py.
+
+'''
+import argparse
+import os
+import resource
+import runpy
+import sys
+import tempfile
+import time
+
+def generate(sections):
+    '''Return the text of a document with sections top-level sections.'''
+    lines = ['@ title Big']
+    for s in range(sections):
+        lines += ['* Section ' + str(s)]
+        for k in range(10):
+            lines += ['Some prose with an equation \\(x_{' + str(k) + '}^2 + y$x ' + str(k)
+                      + ' squared plus y$\\) and more words here.',
+                      '- a list item with \\(\\alpha\\) in it',
+                      '  - nested item text',
+                      '# Theorem thm:' + str(s) + '_' + str(k) + ' Name',
+                      '  Statement of theorem with $$ and \\[z\\] stuff.',
+                      '']
+    return '\n'.join(lines) + '\n'
+
+def load(lxl_file, filename):
+    '''Load lxl_file as a module (without running its __main__ part).'''
+    sys.argv = ['lxl.py', filename]
+    return runpy.run_path(lxl_file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak RSS per 1,000 lines of a parsed .lxl file.')
+    parser.add_argument('--sections', type=int, default=200)
+    parser.add_argument('--lxl', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lxl.py'))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'big.lxl')
+        text = generate(args.sections)
+        with open(filename, 'w') as f:
+            f.write(text)
+        lines = text.count('\n')
+
+        lxl = load(args.lxl, filename)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        document = lxl['Document'](filename)
+        elapsed = time.perf_counter() - started
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    growth = (after - before) / scale
+    print('%d lines: peak RSS grew %.1f MB, %.2f MB per 1,000 lines, parsed in %.2fs'
+          % (lines, growth, growth / (lines / 1000), elapsed))
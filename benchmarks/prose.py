@@ -0,0 +1,105 @@
+'''Time serialising the paragraphs of a 1 MB prose document.
+
+Generates about 1 MB of prose with the odd inline equation, parses it
+and times turning it into alt text (so LaTeXML isn't needed):
+
+- every Paragraph's accessible(),
+- Line.accessible() over the same characters,
+- the whole page.
+
+    python benchmarks/prose.py [--size 1000000] [--repeat 5] [--lxl path/to/lxl.py]
+
+Times are the best of --repeat runs. Use --lxl to time another version
+of lxl.py, e.g. one from git show <commit>:lxl.py > /tmp/old_lxl.py.
+
+'''
+import argparse
+import os
+import random
+import runpy
+import sys
+import tempfile
+import time
+
+vocabulary = ('the of and a to in is that it for as with was on be by this are or from at '
+              'which an have not theorem matrix exponential converges series eigenvalue '
+              'function space').split()
+
+def generate(size):
+    '''Return the text of a prose document of about size characters.'''
+    rng = random.Random(0)
+    lines = ['@ title Prose benchmark', '']
+    length = 0
+    n = 0
+    while length < size:
+        if n % 20 == 0:
+            lines += ['* Section ' + str(n // 20), '']
+        sentences = []
+        for k in range(rng.randint(4, 9)):
+            sentence = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(8, 20)))
+            if rng.random() < 0.15:
+                sentence += ' where \\(x_{' + str(k) + '}\\) holds'
+            sentences += [sentence.capitalize() + '.']
+        lines += [' '.join(sentences), '']
+        length += len(lines[-2]) + 1
+        n += 1
+    return '\n'.join(lines) + '\n'
+
+def load(lxl_file, filename):
+    '''Load lxl_file as a module (without running its __main__ part).'''
+    sys.argv = ['lxl.py', filename]
+    return runpy.run_path(lxl_file)
+
+def best(repeat, job):
+    '''Return the shortest time job() took in repeat runs, and its result.'''
+    times = []
+    for k in range(repeat):
+        started = time.perf_counter()
+        result = job()
+        times += [time.perf_counter() - started]
+    return min(times), result
+
+def characters(paragraph):
+    '''The characters and Equations of paragraph, one by one.'''
+    if hasattr(type(paragraph), 'runs'):
+        return [c for run in paragraph.runs
+                for c in (run if type(run).__name__ == 'str' else [run])]
+    else:
+        return paragraph.chars
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the alt text of a prose document.')
+    parser.add_argument('--size', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--lxl', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lxl.py'))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'prose.lxl')
+        text = generate(args.size)
+        with open(filename, 'w') as f:
+            f.write(text)
+        lxl = load(args.lxl, filename)
+        document = lxl['Document'](filename)
+
+    paragraphs = [x for section in document.main.sections
+                  for sct, x in lxl['elements'](section)
+                  if type(x).__name__ == 'Paragraph']
+    Line = lxl['Line']
+    lines = []
+    for paragraph in paragraphs:
+        # Only the characters matter to Line.accessible()
+        line = Line.__new__(Line)
+        line.chars = characters(paragraph)
+        lines += [line]
+
+    paragraph_time, paragraph_text = best(args.repeat, lambda: [x.accessible('alt') for x in paragraphs])
+    line_time, line_text = best(args.repeat, lambda: [x.accessible('alt') for x in lines])
+    page_time, page = best(args.repeat, lambda: document.accessible('alt'))
+    if line_text != paragraph_text:
+        raise Exception('Line and Paragraph give different text')
+
+    print('%d bytes, %d paragraphs' % (len(text), len(paragraphs)))
+    print('Paragraph.accessible: %.3fs' % paragraph_time)
+    print('Line.accessible:      %.3fs' % line_time)
+    print('whole page:           %.3fs' % page_time)
@@ -1,17 +1,133 @@
 from subprocess import run, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import argparse
+import asyncio
+import base64
+import collections
+import contextlib
+import gzip
+import hashlib
+import io
 import itertools
-import more_itertools as mit
+import json
+import os
+import pickle
 import random
+import re
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
 import yaml
 
+try:
+    import brotli
+except ImportError:
+    brotli = None # no .br files then
+
 theorem_list = ['Lemma', 'Theorem', 'Corollary', 'Definition', 'Example', 'Proposition', 'Proof', 'Remark']
 meta_tags =  ['title', 'author', 'description']
 img_path = './img/'
-
-input_file = sys.argv[1]
+image_format = 'jpeg' # how tikzpictures are turned into images: 'jpeg', 'png', 'svg' or 'dvisvgm'
+image_resolution = 150 # dots per inch for jpeg and png images
+image_scaling = False # if True, jpeg and png images are shown at their real size (see image_size())
+image_extensions = {'jpeg': '.jpg', 'png': '.png', 'svg': '.svg', 'dvisvgm': '.svg'}
+image_types = {'.jpg': 'image/jpeg', '.png': 'image/png', '.svg': 'image/svg+xml'}
+verbatim_tags = ['math', 'pre', 'script', 'style', 'textarea'] # minify() leaves the insides of these alone
+tool_limits = {'latexmlmath': 8, 'tex': 2} # how many of each external tool a Pipeline runs at once
+job_limit = 10000 # how many jobs (i.e. equations) serve's Pipeline remembers
+pipeline = None # set to a Pipeline to run external tools concurrently
+serve_root = None # when serving, files named by @ commands must be in here
+rendering = threading.local() # when serving, rendering.folder is where this thread's request builds its images
+label_file = 'labels.json' # the label index goes here, next to the nav outline
+label_index = None # set to a LabelIndex to resolve \ref{...}
+search_folder = 'search' # the search index goes here, next to the nav outline
+shard_length = 2 # search terms are sharded by their first shard_length characters
+lazy_loader = '''<script>
+// Fill in the sections of a split page (see Document.write) as they
+// scroll into view, or when something inside them is linked to.
+(function () {
+  function load(section) {
+    var url = section.getAttribute('data-fragment');
+    section.removeAttribute('data-fragment');
+    return fetch(url).then(function (response) {
+      return response.text();
+    }).then(function (html) {
+      var id = section.id;
+      section.outerHTML = html;
+      if (window.MathJax) {
+        MathJax.Hub.Queue(['Typeset', MathJax.Hub, document.getElementById(id)]);
+      }
+    });
+  }
+  function show(id) {
+    var target = id && document.getElementById(id);
+    var section = target ? target.closest('section[data-fragment]')
+                         : id && document.querySelector('section[data-fragment]');
+    if (section) {
+      load(section).then(function () { show(id); });
+    } else if (target) {
+      target.scrollIntoView();
+    }
+  }
+  var observer = new IntersectionObserver(function (entries) {
+    entries.forEach(function (entry) {
+      if (entry.isIntersecting && entry.target.hasAttribute('data-fragment')) {
+        observer.unobserve(entry.target);
+        load(entry.target);
+      }
+    });
+  }, {rootMargin: '500px'});
+  document.querySelectorAll('section[data-fragment]').forEach(function (section) {
+    observer.observe(section);
+  });
+  window.addEventListener('hashchange', function () { show(location.hash.slice(1)); });
+  show(location.hash.slice(1));
+})();
+</script>'''
+mathml_defaults = [' xmlns="http://www.w3.org/1998/Math/MathML"', ' display="inline"'] # attributes minify() can drop
+lxl_version = '0.4' # bump this whenever the parse tree changes shape
+
+parser = argparse.ArgumentParser(description='Turn an .lxl file into an HTML page with MathML and an HTML page with alt text.')
+parser.add_argument('input_file',
+                    help='the .lxl file, or "serve" to run a local rendering service instead')
+parser.add_argument('--stream', action='store_true',
+                    help='read and render the file one top-level section at a time (for very large files)')
+parser.add_argument('--minify', action='store_true',
+                    help='collapse whitespace and drop redundant MathML attributes in the output')
+parser.add_argument('--compress', action='store_true',
+                    help='also write .gz (and, if the brotli module is installed, .br) copies of the output')
+parser.add_argument('--parallel', action='store_true',
+                    help='run LaTeXML and TeX in the background, several at a time')
+parser.add_argument('--images', choices=sorted(image_extensions), default=image_format,
+                    help='image format for tikzpictures: jpeg or png (via pdftocairo) or svg (via pdftocairo or dvisvgm)')
+parser.add_argument('--dpi', type=int, default=image_resolution,
+                    help='resolution of jpeg and png images')
+parser.add_argument('--scale-images', action='store_true',
+                    help='show jpeg and png images at their real size (--dpi dots per inch) rather than one pixel per dot')
+parser.add_argument('--split', action='store_true',
+                    help='put each top-level section after the first in its own file, loaded as the reader gets to it')
+parser.add_argument('--labels', action='store_true',
+                    help='resolve \\ref{label} using the labels of all the documents in the @ nav outline')
+parser.add_argument('--index', action='store_true',
+                    help='update the search index for all the documents in the @ nav outline')
+parser.add_argument('--port', type=int, default=8000,
+                    help='port for "serve" to listen on (on localhost)')
+parser.add_argument('--workers', type=int, default=4,
+                    help='how many requests "serve" renders at once')
+parser.add_argument('--root', default='.',
+                    help='folder which "serve" looks in for the files named by @ headcontent, @ footer and @ nav')
+args = parser.parse_args()
+
+input_file = args.input_file
 output_mathml = input_file[:-4] + '.html'
 output_accessible = input_file[:-4] + '_accessible' + '.html'
+output_cache = input_file[:-4] + '.lxlc'
+output_terms = input_file[:-4] + '.terms.json'
 
 def split_by_char(_list, char):
     return [list(y)
@@ -19,6 +135,492 @@ def split_by_char(_list, char):
                                           lambda z: z == char)
             if not x]
 
+def text_runs(chars):
+    '''Join each stretch of ordinary characters in chars into one string.
+
+    Returns a list of strings and Equations, so anything going through
+    it only has to check what kind of node it has once per run of
+    text, not once per character.
+
+    '''
+    runs = []
+    for kind, run in itertools.groupby(chars, type):
+        if kind.__name__ == 'str':
+            runs += [''.join(run)]
+        else:
+            runs += run
+    return runs
+
+def group_chars(text):
+    '''Merge \(, $$, \$, etc in text into single characters.'''
+    shifted_text = text[1:] + ' '
+    chars = []
+    skip_next_char = 0
+    for x, y in zip(text, shifted_text):
+        if skip_next_char == 0:
+            merge_test_1 = (x == '\\' and y in ['(', ')', '[', ']', '$'])
+            merge_test_2 = (x == '$' and y == '$')
+            if merge_test_1 or merge_test_2:
+                # Lots of these, so share one copy of each
+                chars += [sys.intern(x + y)]
+                skip_next_char = 1
+            else:
+                chars += [x]
+        else:
+            skip_next_char = 0
+
+    return chars
+
+def read_lines(source, mode):
+    '''Generate a Line for each line of source (e.g. an open file).
+
+    Lines are produced as they are read, so source never needs to be
+    in memory all at once. Equations can run over several lines, so
+    we remember from one line to the next whether we are inside one.
+
+    '''
+    if mode == '\\(':
+        delimiters = ['\\[', '\\(', '\\]', '\\)', '$$']
+    elif mode == '$':
+        delimiters = ['\\[', '$', '\\]', '$$']
+    in_eq = False
+    blank_lines = 1
+
+    for text in source:
+        chars = group_chars(text.rstrip('\n'))
+        if chars:
+            blank_lines = 0
+        else:
+            # Blank lines become whitespace lines (which merge() turns
+            # into parbreaks): one for each pair of consecutive
+            # newlines, so a run of blank lines counts as one or two.
+            blank_lines += 1
+            if blank_lines % 2 == 0:
+                continue
+            chars = [' ']
+        char_map = []
+        for char in chars:
+            if char in delimiters:
+                char_map += [True]
+                in_eq = not in_eq
+            else:
+                char_map += [in_eq]
+        yield Line(chars, char_map)
+
+def walk(root, children = 'contents', skip = ()):
+    '''Generate root and everything inside it, parents before children.
+
+    This uses a stack rather than recursion, so there is no limit on
+    how deeply things can be nested. A node's children are only looked
+    up once the node has been generated, so the caller is free to
+    rewrite them first (which is how taggify() etc work).
+
+    - children is the name of the attribute holding a node's children
+      ('contents' for Environments, 'sections' for Sections).
+
+    - nothing inside an environment whose name is in skip is
+      generated (e.g. we don't merge the lines of a tikzpicture).
+
+    '''
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.name not in skip:
+            stack += reversed(getattr(node, children, []))
+
+def serialise(root, modus):
+    '''Return the HTML for root (and everything inside it) as a string.
+
+    Each node describes its output by node.parts(modus): a list of
+    strings and child nodes. The children are expanded in place using
+    a stack (not recursion) and all the strings end up joined by
+    newlines, exactly as if each node had joined its own parts.
+
+    '''
+    strs = []
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if type(item).__name__ == 'str':
+            strs += [item]
+        else:
+            stack += reversed(item.parts(modus))
+    return '\n'.join(strs)
+
+def image_size(filename):
+    '''Return the (width, height) of an image in CSS pixels.
+
+    Works for JPEG, PNG and SVG files. JPEG and PNG images are shown
+    one pixel per dot, unless image_scaling is True: a CSS pixel is
+    1/96 inch, so then their sizes are scaled from image_resolution
+    dots per inch (which is what pdftocairo made them at) and a figure
+    comes out the same size whichever image_format or
+    image_resolution is used. SVG sizes in pt are converted to pixels.
+    Returns None if the file is missing or we can't tell.
+
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    dots = raster_size(data)
+    if dots and image_scaling:
+        return tuple(round(x * 96 / image_resolution) for x in dots)
+    elif dots:
+        return dots
+    else:
+        return svg_size(data)
+
+def raster_size(data):
+    '''Return the (width, height) in dots of a PNG or JPEG image (in bytes).'''
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return struct.unpack('>II', data[16:24])
+    elif data[:2] == b'\xff\xd8':
+        # Look through the JPEG markers for the start of the frame
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xff:
+                return None
+            marker, length = struct.unpack('>BH', data[i+1:i+4])
+            if 0xc0 <= marker <= 0xcf and marker not in [0xc4, 0xc8, 0xcc]:
+                height, width = struct.unpack('>HH', data[i+5:i+9])
+                return width, height
+            i += 2 + length
+    return None
+
+def svg_size(data):
+    '''Return the (width, height) in CSS pixels of an SVG image (in bytes).'''
+    svg_tag = re.search(rb'<svg[^>]*>', data)
+    if not svg_tag:
+        return None
+    size = []
+    for dimension in [b'width', b'height']:
+        value = re.search(dimension + rb'''=["']([0-9.]+)(pt|px)?["']''', svg_tag.group(0))
+        if not value:
+            return None
+        number = float(value.group(1))
+        if value.group(2) == b'pt':
+            number = number * 96 / 72
+        size += [round(number)]
+    return tuple(size)
+
+def minify(html):
+    '''Make html smaller without changing how it displays.
+
+    Runs of (ASCII) whitespace are collapsed to a single space, except
+    inside the verbatim_tags. Non-breaking spaces are left alone: they
+    mean something, in the text and in MathML alike. Inside MathML, whitespace between tags means
+    nothing so it is dropped altogether, as are the attributes in
+    mathml_defaults (LaTeXML puts these on every equation).
+
+    '''
+    strs = []
+    position = 0
+    verbatim = '<(' + '|'.join(verbatim_tags) + r')\b.*?</\1>'
+    for match in re.finditer(verbatim, html, re.S):
+        strs += [re.sub(r'[ \t\n\r\f]+', ' ', html[position:match.start()])]
+        if match.group(1) == 'math':
+            mathml = re.sub(r'>[ \t\n\r\f]+<', '><', match.group(0))
+            for attribute in mathml_defaults:
+                mathml = mathml.replace(attribute, '')
+            strs += [mathml]
+        else:
+            strs += [match.group(0)]
+        position = match.end()
+    strs += [re.sub(r'[ \t\n\r\f]+', ' ', html[position:])]
+    return ''.join(strs)
+
+def compress(filename):
+    '''Write precompressed copies of filename for the web server.
+
+    filename.gz is always written; filename.br only if brotli is
+    installed (otherwise any old filename.br is removed).
+
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open(filename + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, 9, mtime = 0))
+    if brotli:
+        with open(filename + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality = 11))
+    elif os.path.exists(filename + '.br'):
+        os.remove(filename + '.br')
+
+def remove_compressed(filenames):
+    '''Remove the precompressed copies of filenames, which are out of date.
+
+    Otherwise a web server which prefers them would go on serving the
+    old versions.
+
+    '''
+    for filename in filenames:
+        for copy in [filename + '.gz', filename + '.br']:
+            if os.path.exists(copy):
+                os.remove(copy)
+
+def compress_all(filenames):
+    '''Compress all the files in filenames at the same time.'''
+    with ThreadPoolExecutor() as pool:
+        list(pool.map(compress, filenames))
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('UTF-8')).hexdigest()
+
+def resolve_refs(text, modus):
+    '''Replace each \\ref{label} in text by a link, using label_index.'''
+    if label_index == None or '\\ref{' not in text:
+        return text
+    return re.sub(r'\\ref\{([^}]*)\}',
+                  lambda match: label_index.link(match.group(1), modus),
+                  text)
+
+def elements(section, skip = ()):
+    '''Generate (sct, x) for every x in the processed contents of section.
+
+    sct is the subsection of section (or section itself) which x
+    belongs to. skip is as for walk().
+
+    '''
+    for sct in walk(section, 'sections'):
+        for envelope in sct.orphaned_contents:
+            for x in walk(envelope, skip = skip):
+                yield sct, x
+
+def section_labels(section, labels):
+    '''Add the labelled environments in section and its subsections to labels.
+
+    labels is a dictionary {label: [section idnum, display name]}.
+
+    '''
+    for sct, x in elements(section):
+        if type(x).__name__ == 'Environment' and x.name in theorem_list and x.additional:
+            labels[x.additional[0]] = [sct.idnum, x.title()]
+
+def schedule(section):
+    '''Start the conversions needed by section and its subsections.'''
+    for sct, x in elements(section, skip = ['tikzpicture']):
+        x.schedule()
+
+@contextlib.contextmanager
+def unscheduled():
+    '''Anything parsed inside this block doesn't start any conversions.'''
+    global pipeline
+    saved, pipeline = pipeline, None
+    try:
+        yield
+    finally:
+        pipeline = saved
+
+def words(text):
+    '''Split text (which may contain HTML tags) into search terms.'''
+    return re.findall('[a-z0-9]+', re.sub('<[^>]*>', ' ', text).lower())
+
+def section_terms(section, terms):
+    '''Add the search terms in section and its subsections to terms.
+
+    terms is a dictionary {term: set of section idnums}. We index
+    headings and paragraphs, where equations are replaced by their
+    alt text. A term points at the innermost section containing it.
+
+    '''
+    for sct in walk(section, 'sections'):
+        strs = [sct.name]
+        for envelope in sct.orphaned_contents:
+            strs += [x.accessible('alt') for x in walk(envelope)
+                     if type(x).__name__ == 'Paragraph']
+        for term in words(' '.join(strs)):
+            terms.setdefault(term, set()).add(sct.idnum)
+
+def build_search_index(outline_file):
+    '''Rebuild the search index of all the notes listed in outline_file.
+
+    Each note contributes the terms saved in its .terms.json file when
+    it was last built (notes which haven't been built are left out),
+    so only the document which has just been rebuilt is re-read. The
+    index lives in search_folder, next to outline_file:
+
+    - index.json lists the documents (their names, titles and the
+      section idnums which postings refer to) and the shards.
+
+    - <prefix>.json is the shard of terms beginning with <prefix>.
+      Its terms are sorted and front-coded: each entry is [number of
+      characters shared with the previous term, rest of the term,
+      postings], where postings is a list of [document number,
+      [section numbers]].
+
+    Shards which haven't changed are not rewritten. Returns the list
+    of files which were.
+
+    '''
+    folder = os.path.join(os.path.dirname(outline_file), search_folder)
+    outline = site.outline(outline_file)
+
+    docs = []
+    shards = {}
+    for name in outline['notes']:
+        terms_file = os.path.join(os.path.dirname(outline_file), name + '.terms.json')
+        try:
+            with open(terms_file, "r") as f:
+                terms = json.load(f)
+        except OSError:
+            continue
+        idnums = sorted(set(x for y in terms.values() for x in y))
+        section_number = {idnum: k for k, idnum in enumerate(idnums)}
+        for term, sections in terms.items():
+            postings = shards.setdefault(term[:shard_length], {}).setdefault(term, [])
+            postings += [[len(docs), sorted(section_number[x] for x in sections)]]
+        docs += [{'name': name, 'title': outline['titles'][name], 'sections': idnums}]
+
+    files = {'index.json': {'docs': docs, 'shards': sorted(shards)}}
+    for prefix, terms in shards.items():
+        entries = []
+        previous = ''
+        for term in sorted(terms):
+            shared = len(os.path.commonprefix([previous, term]))
+            entries += [[shared, term[shared:], terms[term]]]
+            previous = term
+        files[prefix + '.json'] = entries
+
+    os.makedirs(folder, exist_ok = True)
+    written = []
+    for filename in os.listdir(folder):
+        shard = re.sub(r'\.(gz|br)$', '', filename)
+        if shard.endswith('.json') and shard not in files:
+            # A shard whose terms have all gone (or a compressed copy of one)
+            os.remove(os.path.join(folder, filename))
+    for filename, data in files.items():
+        path = os.path.join(folder, filename)
+        text = json.dumps(data, separators = (',', ':'))
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                if f.read() == text:
+                    continue
+        with open(path, "w") as f:
+            f.write(text)
+        # --compress makes new copies from written
+        remove_compressed([path])
+        written += [path]
+    return written
+
+class Pipeline:
+    def __init__(self, limits, max_jobs = None, keep = True):
+        '''Runs external tools (LaTeXML, TeX) in the background.
+
+        Jobs are run by an asyncio event loop in a separate thread,
+        starting as soon as they're submitted, with at most
+        limits[tool] copies of each tool running at any one time.
+        Submitting a job gives you a future and you only wait for its
+        result when you need it (i.e. when the document is written),
+        so the conversions run alongside parsing and each other.
+        Identical jobs are only run once, unless they failed.
+
+        If max_jobs is given then only the max_jobs most recently
+        used jobs are remembered, so a long-running Pipeline doesn't
+        grow forever. If keep is False then a job is forgotten as soon
+        as everything which scheduled it has had its result (see
+        result()), which is all a build needs: then a streamed build
+        only holds on to the MathML of the section being written.
+
+        '''
+        self.limits = limits
+        self.max_jobs = max_jobs
+        self.keep = keep
+        self.waiting = collections.Counter() # {key: how many schedule()s haven't had the result}, unless self.keep
+        self.semaphores = {}
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0   # jobs scheduled which had already been done
+        self.misses = 0 # jobs scheduled for the first time
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+
+    def submit(self, tool, commands, files = {}, cwd = None):
+        '''Run commands (a list of argument lists) one after another.
+
+        files is a dictionary {filename: contents} of files to write
+        first. The commands are run in (and filenames are relative
+        to) cwd, if given. Returns a concurrent.futures.Future whose
+        result is the output of the last command.
+
+        '''
+        key = self.key(tool, commands, files, cwd)
+        with self.lock:
+            if key in self.jobs:
+                self.jobs.move_to_end(key)
+            else:
+                self.jobs[key] = asyncio.run_coroutine_threadsafe(self.run(key, tool, commands, files, cwd),
+                                                                  self.loop)
+                if self.max_jobs and len(self.jobs) > self.max_jobs:
+                    self.jobs.popitem(last = False)
+            return self.jobs[key]
+
+    def schedule(self, tool, commands, files = {}, cwd = None):
+        '''Like submit(), but keeping count of how often the job was already done.'''
+        with self.lock:
+            if self.key(tool, commands, files, cwd) in self.jobs:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if not self.keep:
+                self.waiting[self.key(tool, commands, files, cwd)] += 1
+        return self.submit(tool, commands, files, cwd)
+
+    def result(self, tool, commands, files = {}, cwd = None):
+        '''Wait for the job and return its output.
+
+        Unless self.keep, the job is forgotten once this has been
+        called as often as schedule() was.
+
+        '''
+        output = self.submit(tool, commands, files, cwd).result()
+        if not self.keep:
+            key = self.key(tool, commands, files, cwd)
+            with self.lock:
+                self.waiting[key] -= 1
+                if self.waiting[key] <= 0:
+                    del self.waiting[key]
+                    self.jobs.pop(key, None)
+        return output
+
+    def key(self, tool, commands, files, cwd):
+        return (tool, repr(commands), repr(sorted(files.items())), cwd)
+
+    def forget(self, key):
+        '''Drop the job called key, so that it's run again next time.'''
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    async def run(self, key, tool, commands, files, cwd):
+        if tool not in self.semaphores:
+            self.semaphores[tool] = asyncio.Semaphore(self.limits.get(tool, 1))
+        try:
+            async with self.semaphores[tool]:
+                for filename, content in files.items():
+                    with open(os.path.join(cwd or '', filename), "w") as f:
+                        f.write(content)
+                for command in commands:
+                    process = await asyncio.create_subprocess_exec(*command,
+                                                                   stdout = asyncio.subprocess.PIPE,
+                                                                   cwd = cwd)
+                    output, _ = await process.communicate()
+                    if process.returncode != 0:
+                        # Whoever submitted it gets what output there
+                        # is, but the next submission tries again
+                        self.forget(key)
+        except Exception:
+            self.forget(key)
+            raise
+        return output
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
 class Equation:
     '''Equation:
 
@@ -38,6 +640,8 @@ class Equation:
     If you omit them then the alt text will simply be the text of your equation, e.g.
     $x$ will give alt text x.
     '''
+    __slots__ = ('text', 'latex', 'alt_text')
+
     def __init__(self, text):
         '''Create an equation with a string of text.
 
@@ -49,29 +653,40 @@ class Equation:
 
     def close(self):
         '''Use when all text has been entered and Equation is ready to be processed.'''
-        self.body = self.text[1:-1] # the equation without its outermost delimiters
-        if '$' in self.body:
+        body = self.text[1:-1] # the equation without its outermost delimiters
+        if '$' in body:
             # $...$ is being used to insert alt text
-            partition = split_by_char(self.body, '$')
-        elif '\(' in self.body:
+            partition = split_by_char(body, '$')
+        elif '\(' in body:
             # \(...\) is being used to insert alt text
-            partition = split_by_char(self.body[:-1], '\(')
+            partition = split_by_char(body[:-1], '\(')
         else:
-            # use self.body as alt text
-            partition = [self.body, self.body]
+            # use body as alt text
+            partition = [body, body]
         self.latex = str(self.text[0]) + ''.join(partition[0]) + str(self.text[-1])
         self.alt_text = ''.join(partition[1])
+        del self.text # everything we need is in self.latex and self.alt_text now
         
+    def latexml_command(self):
+        return ["latexmlmath",
+                "--pmml",
+                "-",
+                self.macros()]
+
     def latexml(self):
         '''Get MathML code for self using LaTeXML.'''
-        latex_code = self.macros()
-        xml_code = run(["latexmlmath",
-                        "--pmml",
-                        "-",
-                        latex_code], stdout=PIPE)
-        mathml_code = xml_code.stdout.decode('UTF-8')[39:]
+        if pipeline:
+            xml_code = pipeline.result('latexmlmath', [self.latexml_command()])
+        else:
+            xml_code = run(self.latexml_command(), stdout=PIPE).stdout
+        mathml_code = xml_code.decode('UTF-8')[39:]
         return mathml_code
 
+    def schedule(self):
+        '''Start converting self to MathML in the background, if we can.'''
+        if pipeline:
+            pipeline.schedule('latexmlmath', [self.latexml_command()])
+
     def macros(self):
         '''Implement some basic macros
 
@@ -131,7 +746,12 @@ class Element:
     (e.g. can write x.equify() and not worry about whether x is a Line
     or an Environment). These get redefined when it's important.
 
+    There are a lot of these in a big document, so they all use
+    __slots__ rather than a __dict__.
+
     '''
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -155,8 +775,16 @@ class Element:
     
     def group_list_items(self):
         pass
+
+    def schedule(self):
+        pass
+
+    def parts(self, modus):
+        return [self.accessible(modus)]
     
 class Line(Element):
+    __slots__ = ('name', 'chars', 'char_map', 'level', 'indent')
+
     def __init__(self, chars, char_map):
         '''Line object.
 
@@ -170,6 +798,13 @@ class Line(Element):
         self.chars = chars
         self.char_map = char_map
 
+        # Number of * characters (not in an equation) at the beginning
+        # of the line, i.e. the depth of the section it starts (if any)
+        level = 0
+        while level < len(chars) and self.is_star(level):
+            level += 1
+        self.level = level
+
         non_whitespace_indices = [i for i in range(0,len(chars))
                                   if not(chars[i].isspace())]
         if non_whitespace_indices:
@@ -200,20 +835,7 @@ class Line(Element):
     
     def stars(self):
         '''Count the number of * characters at the beginning of self.'''
-        star_indices = [i for i in range(0,len(self.chars))
-                        if self.is_star(i)]
-        
-        if star_indices:
-            # If there are any stars on the line...
-            if min(star_indices) == 0:
-                # If there is a * character at the beginning of the line
-                # return the number of * in the initial clump of * characters
-                star_groups = [list(group) for group in mit.consecutive_groups(star_indices)]
-                return len(star_groups[0])
-            else:
-                return 0
-        else:
-            return 0
+        return self.level
 
     def envify(self):
         '''Turns lines of the form '# environment' into Environments.
@@ -228,6 +850,30 @@ class Line(Element):
         else:
             return self
 
+    def listify(self):
+        '''Turns lines of the form '- item' or '+ item' into list items.
+
+        Returns a list of two Lines, '# uli' (or '# oli') and '  item',
+        on the same indent as self, so that taggify() later puts the
+        item inside a list item environment. Any other line is returned
+        unchanged (as a list of one Line).
+
+        '''
+        i = self.indent
+        if i != None and self.chars[i] in ['-', '+'] and self.char_map[i] == False:
+            if self.chars[i] == '-':
+                list_item = 'uli'
+            else:
+                list_item = 'oli'
+            new_line_1 = self.chars[0:i] + ['#'] + [' '] + [list_item]
+            new_map_1 = [False for k in range(0, i+3)]
+            new_line_2 = self.chars[0:i] + [' '] + [' '] + self.chars[i + 2:]
+            new_map_2 = [False for k in range(0, i+2)] + self.char_map[i + 2:]
+            return [Line(new_line_1, new_map_1),
+                    Line(new_line_2, new_map_2)]
+        else:
+            return [self]
+
     def equify(self):
         '''Extracts LaTeX from lines
 
@@ -264,6 +910,11 @@ class Line(Element):
         self.chars = new_line
         self.char_map = new_map
 
+    def schedule(self):
+        for x in self.chars:
+            if type(x).__name__ == 'Equation':
+                x.schedule()
+
     def split_paragraphs(self):
         '''Splits line into paragraphs according to parbreaks
 
@@ -297,13 +948,13 @@ class Line(Element):
         return self.accessible('mathml')
 
     def accessible(self, modus):
-        strs = ''
-        for x in self.chars:
-            if type(x).__name__ == 'str':
-                strs += x
+        strs = []
+        for run in text_runs(self.chars):
+            if type(run).__name__ == 'str':
+                strs += [run]
             else:
-                strs += x.accessible(modus)
-        return strs
+                strs += [run.accessible(modus)]
+        return ''.join(strs)
 
     def __add__(self, other):
         '''Merge lines (adding a space between)
@@ -333,9 +984,24 @@ class Line(Element):
         return cls(['parbreak'], [False])
 
 class Paragraph(Element):
+    __slots__ = ('name', 'runs')
+
     def __init__(self, chars):
+        '''Paragraph object.
+
+        chars is a list of characters and Equations, as in an equified
+        Line. Nothing looks at the characters of a paragraph one by
+        one after this, so we only keep the runs of text between the
+        equations (see text_runs()).
+
+        '''
         self.name = 'p'
-        self.chars = chars
+        self.runs = text_runs(chars)
+
+    def schedule(self):
+        for x in self.runs:
+            if type(x).__name__ == 'Equation':
+                x.schedule()
         
     def __str__(self):
         return self.__repr__()
@@ -344,15 +1010,17 @@ class Paragraph(Element):
         return self.accessible('mathml')
 
     def accessible(self, modus):
-        strs = ''
-        for x in self.chars:
-            if type(x).__name__ == 'str':
-                strs += x
+        strs = []
+        for run in self.runs:
+            if type(run).__name__ == 'str':
+                strs += [resolve_refs(run, modus)]
             else:
-                strs += x.accessible(modus)
-        return strs
+                strs += [run.accessible(modus)]
+        return ''.join(strs)
         
 class Environment(Element):
+    __slots__ = ('indent', 'name', 'additional', 'contents')
+
     def __init__(self, line, indent = -1):
         '''Create empty environment
 
@@ -377,7 +1045,7 @@ class Environment(Element):
             self.indent = indent
             instruction = line.split()
         assert instruction[0] == '#'
-        self.name = instruction[1]
+        self.name = sys.intern(instruction[1])
         if len(instruction) > 2:
             self.additional = instruction[2:]
         else:
@@ -386,17 +1054,26 @@ class Environment(Element):
 
     def process(self):
         '''Apply various (non-recursive) processes to the elements of self.content
-        and then recursively apply these processes to their children.'''
+        and then apply these processes to their children, and so on down.'''
         if self.name == 'tikzpicture':
             # Don't touch this
             return None
-        
-        self.taggify()
-        self.merge()
-        self.equify()
 
-        self.make_paragraphs() # Split Lines into Paragraphs
-        self.group_list_items()
+        for x in walk(self):
+            x.taggify()
+        for x in walk(self, skip = ['tikzpicture']):
+            x.merge()
+        for x in walk(self):
+            x.equify()
+        # Get the conversions going as soon as the equations exist
+        for x in walk(self, skip = ['tikzpicture']):
+            x.schedule()
+
+        # Split Lines into Paragraphs
+        for x in walk(self, skip = ['tikzpicture']):
+            x.make_paragraphs()
+        for x in walk(self):
+            x.group_list_items()
 
             
     def taggify(self):
@@ -447,8 +1124,6 @@ class Environment(Element):
                 open_environment = new_contents[-1]
                 
         self.contents = new_contents
-        for x in self.contents:
-            x.taggify()
 
     def merge(self):
         '''Operates on self.contents
@@ -462,9 +1137,8 @@ class Environment(Element):
             # We don't want to merge tikzpictures
             return None
             
-        merged = [self.contents.pop(0)]
-        while self.contents:
-            line = self.contents.pop(0)
+        merged = [self.contents[0]]
+        for line in self.contents[1:]:
             if type(line).__name__ == 'Environment':
                 # Environments don't merge
                 merged += [line]
@@ -480,14 +1154,6 @@ class Environment(Element):
                     merged += [line]
 
         self.contents = merged
-        for x in self.contents:
-            x.merge()
-        
-    def equify(self):
-        '''Convert LaTeX into equations in any children.'''
-
-        for line in self.contents:
-            line.equify()
 
     def make_paragraphs(self):
         '''Operates on self.contents.
@@ -505,8 +1171,6 @@ class Environment(Element):
             paragraphed += line.split_paragraphs()
 
         self.contents = paragraphed        
-        for x in self.contents:
-            x.make_paragraphs()
         
     def group_list_items(self):
         '''Operates on self.contents
@@ -540,9 +1204,65 @@ class Environment(Element):
 
         self.contents = new_contents
         
-        for x in self.contents:
-            x.group_list_items()
+    def tikz_job(self):
+        '''Work out how to make the image for a tikzpicture Environment.
+
+        Returns the files to write, as a dictionary {filename:
+        contents}, and the commands to run afterwards.
+
+        '''
+        stump = img_path + self.image_name()
+        latex_tmp = stump + '.tex'
+        pdf_tmp = self.image_name() + '.pdf'
+        dvi_tmp = self.image_name() + '.dvi'
         
+        preamble = ['\\documentclass{standalone}',
+                    '\\usepackage{amsmath}']
+        if image_format == 'dvisvgm':
+            preamble += ['\\def\\pgfsysdriver{pgfsys-dvisvgm.def}']
+        file_content = '\n'.join(preamble + ['\\usepackage{tikz}',
+                                              '\\begin{document}',
+                                              '\\begin{tikzpicture}'])
+        file_content += '\n'.join([c.tikz_str() for c in self.contents])
+        file_content += '\n'.join(['\\end{tikzpicture}',
+                                  '\\end{document}'])
+        
+        if image_format == 'dvisvgm':
+            commands = [["latex",
+                         latex_tmp],
+                        ["dvisvgm",
+                         "--no-fonts",
+                         "--output=" + stump + '.svg',
+                         dvi_tmp]]
+        else:
+            commands = [["pdflatex",
+                         latex_tmp,
+                         "-output-directory="+img_path,
+                         pdf_tmp]]
+            if image_format == 'svg':
+                commands += [["pdftocairo",
+                              "-svg",
+                              pdf_tmp,
+                              stump + '.svg']]
+            else:
+                commands += [["pdftocairo",
+                              "-singlefile",
+                              "-" + image_format,
+                              "-r", str(image_resolution),
+                              pdf_tmp,
+                              stump]]
+        return {latex_tmp: file_content}, commands
+
+    def image_name(self):
+        '''The label of a tikzpicture, cut down to a safe file name.'''
+        return re.sub(r'[^\w-]', '_', str(self.additional[0]))
+
+    def schedule(self):
+        '''Start making the image of a tikzpicture in the background, if we can.'''
+        if self.name == 'tikzpicture' and pipeline:
+            files, commands = self.tikz_job()
+            pipeline.schedule('tex', commands, files, getattr(rendering, 'folder', None))
+
     def make_tikz(self):
         '''Generate image and img tag from tikzpicture Environment.
 
@@ -559,38 +1279,38 @@ class Environment(Element):
             alt_text = ' '.join(self.additional[1:])
         else:
             alt_text = 'No alt text yet, sorry'
-        label_text = str(self.additional[0])
-        
-        stump = img_path + str(self.additional[0])
-        latex_tmp = stump + '.tex'
-        jpg_file = stump
-        pdf_tmp = str(self.additional[0]) + '.pdf'
-        
-        tikz_tmp = open(latex_tmp, "w")
-        file_content = '\n'.join(['\\documentclass{standalone}',
-                                  '\\usepackage{amsmath}',
-                                  '\\usepackage{tikz}',
-                                  '\\begin{document}',
-                                  '\\begin{tikzpicture}'])
-        file_content += '\n'.join([c.tikz_str() for c in self.contents])
-        file_content += '\n'.join(['\\end{tikzpicture}',
-                                  '\\end{document}'])
-        
-        tikz_tmp.write(file_content)
-        tikz_tmp.close()
-        run(["pdflatex",
-             latex_tmp,
-             "-output-directory="+img_path,
-             pdf_tmp])
-        run(["pdftocairo",
-             "-singlefile",
-             "-jpeg",
-             pdf_tmp,
-             jpg_file])
+        image_file = img_path + self.image_name() + image_extensions[image_format]
+        folder = getattr(rendering, 'folder', None)
+
+        files, commands = self.tikz_job()
+        if pipeline:
+            pipeline.result('tex', commands, files, folder)
+        else:
+            for filename, content in files.items():
+                with open(os.path.join(folder or '', filename), "w") as tikz_tmp:
+                    tikz_tmp.write(content)
+            for command in commands:
+                run(command, cwd = folder)
+
+        # Giving the size stops the page jumping about as images load
+        size = image_size(os.path.join(folder or '', image_file))
+        if size:
+            dimensions = ' width="' + str(size[0]) + '" height="' + str(size[1]) + '"'
+        else:
+            dimensions = ''
+
+        source = image_file
+        if folder and os.path.exists(os.path.join(folder, image_file)):
+            # The request's folder is deleted once it's answered, so
+            # the image has to go in the page itself
+            with open(os.path.join(folder, image_file), 'rb') as f:
+                source = ('data:' + image_types[image_extensions[image_format]] + ';base64,'
+                          + base64.b64encode(f.read()).decode('ascii'))
 
         img_tag = '\n'.join(['<figure>'
                              '<center>'
-                             '<img src="' + jpg_file + '.jpg" alt="' + alt_text + '"/>',
+                             '<img src="' + source + '" alt="' + alt_text + '"'
+                             + dimensions + ' loading="lazy"/>',
                              '</center>',
                              '</figure>'])
         
@@ -603,34 +1323,42 @@ class Environment(Element):
     def __repr__(self):
         return self.accessible('mathml')
     
+    def title(self):
+        '''The name of a theorem-like environment, e.g. "Theorem (Gauss's Theorem)"'''
+        if len(self.additional) > 1:
+            text_label = ' '.join(self.additional[1:])
+            return self.name + ' (' + text_label + ')'
+        else:
+            return self.name
+
     def accessible(self, modus):
+        return serialise(self, modus)
+
+    def parts(self, modus):
         if self.name in theorem_list:
             strs = ['<figure class="'+self.name+'">']
             if self.additional:
                 id_label = self.additional[0]
                 strs += ['<figcaption id="' + id_label + '">']
-                if len(self.additional) > 1:
-                    text_label = ' '.join(self.additional[1:])
-                    strs += [self.name + ' (' + text_label + '): ']
-                else:
-                    strs += [self.name + ': ']
+                strs += [self.title() + ': ']
                 strs += ['</figcaption>']
             else:
                 strs += ['<figcaption>' + self.name + ': </figcaption>']
                 
-            strs += [c.accessible(modus) for c in self.contents]
+            strs += self.contents
             strs += ['</figure>']
         elif self.name == 'void':
             # This is a special kind of environment used for
-            # the orphaned content of a section
-            strs = [c.accessible(modus) for c in self.contents]
+            # the orphaned content of a section. If it's empty it
+            # still counts as an (empty) line of output.
+            strs = self.contents or ['']
         elif self.name == 'tikzpicture':
             strs = [self.make_tikz()]
         else:
             strs = ['<'+self.name+'>']
-            strs += [c.accessible(modus) for c in self.contents]
+            strs += self.contents
             strs += ['</'+self.name+'>']
-        return '\n'.join(strs)
+        return strs
 
     
 class Section:
@@ -648,14 +1376,14 @@ class Section:
         self.stars is 1 + the number of "subs" in front of "section".
         self.idnum is a randomly generated unique id for the section
         self.name is the name of the section
-        self.contents is empty but will be filled with the contents
-                      of the section when you run sectionise() on the
-                      section of which this one is a subsection.
+        self.contents is empty (it's only used by Main, which holds
+                      the lines of the whole document until it
+                      runs sectionise()).
         self.orphaned_contents is empty but will be filled with any
-                      content that is not part of a subsection by the
-                      function self.sectionise().
+                      content that is not part of a subsection when
+                      sectionise() is run on the top-level section.
         self.sections is empty but will be filled with a list of 
-                      subsections by self.sectionise().
+                      subsections at the same time.
         '''
         self.idnum = str(random.random())[2:]
         self.stars = line.stars()
@@ -665,62 +1393,53 @@ class Section:
         self.sections = []
 
     def sectionise(self):
-        '''Populates subsections with contents and populates self.sections
-
-        Each section (except Main) is populated with contents by the
-        sectionise() function of its parent (i.e. the section to whose
-        contents it belongs).
-
-        self.sectionise() goes through the contents of a section
-        "self", putting each line into a list called
-        "self.orphaned_contents" until it finds a subsection (i.e. a
-        line starting with stars that are not part of an equation). It
-        then starts building up a list "self.sections" of subsections
-        of depth 1 (i.e. 1 greater than self.stars), populating each
-        one with subsequent lines. Note that a line starting a
-        subsection of greater depth is just added to the most recently
-        opened subsection of depth 1.
-
-        The final act of this function is to run sectionise() on all
-        the subsections of self (so it's effectively recursive).
+        '''Builds the whole hierarchy of subsections from self.contents
+
+        This is done in one pass through self.contents, keeping a
+        stack of the currently open sections (with self at the
+        bottom). A line starting with stars that are not part of an
+        equation starts a new section: first we close every open
+        section of the same depth or deeper, then the new section
+        becomes a subsection of whichever section is left on top of
+        the stack. Any other line is added to the orphaned_contents of
+        the section on top of the stack (i.e. the content which comes
+        before its first subsection).
 
         '''
-        sections = []
-        orphaned_contents = []
-        orphan_mode = True
+        self.orphaned_contents = []
+        self.sections = []
+        stack = [self]
 
         for line in self.contents:
-            if orphan_mode:
-                if line.stars():
-                    orphan_mode = False
-                    sections += [Section(line)]
-                else:
-                    orphaned_contents += [line]
-            elif line.stars() != self.stars + 1:
-                sections[-1].contents += [line]
+            level = line.stars()
+            if level:
+                while len(stack) > 1 and stack[-1].stars >= level:
+                    stack.pop()
+                stack[-1].sections += [Section(line)]
+                stack += [stack[-1].sections[-1]]
             else:
-                sections += [Section(line)]
+                stack[-1].orphaned_contents += [line]
 
-        self.orphaned_contents = orphaned_contents
-        self.sections = sections
-        
-        for sct in self.sections:
-            sct.sectionise()
+        self.contents = [] # everything has been handed on by now
 
     def taggify(self):
         '''Operates on self.orphaned_contents
 
         Puts all orphaned contents into a void environment for further
-        processing. Then applies taggify to subsections.
+        processing. Then does the same for all subsections.
 
         '''
-        envelope = Environment('# void')
-        envelope.contents = self.orphaned_contents
-        envelope.process()
-        self.orphaned_contents = [envelope]
+        for sct in walk(self, 'sections'):
+            envelope = Environment('# void')
+            envelope.contents = sct.orphaned_contents
+            envelope.process()
+            sct.orphaned_contents = [envelope]
 
-        for sct in self.sections:
-            sct.taggify()
+    def process(self):
+        '''Sectionise and taggify self (once self.contents is complete).'''
+        self.sectionise()
+        self.taggify()
+        return self
 
     def __str__(self):
         return self.__repr__()
@@ -729,14 +1448,34 @@ class Section:
         return self.accessible('mathml')
         
     def accessible(self, modus):
-        strs = ['<section id="s'+self.idnum+'" aria-labelledby="h'+self.idnum+'" role="region">']
-        strs += ['<h'+str(self.stars+1)+' id="h'+self.idnum+'">'
-                 +self.name
-                 +'</h'+str(self.stars+1)+'>']
-        strs += [c.accessible(modus) for c in self.orphaned_contents]
-        strs += [c.accessible(modus) for c in self.sections]
+        return serialise(self, modus)
+
+    def section_tag(self, attributes = ''):
+        return '<section id="s'+self.idnum+'" aria-labelledby="h'+self.idnum+'" role="region"'+attributes+'>'
+
+    def heading(self):
+        return ('<h'+str(self.stars+1)+' id="h'+self.idnum+'">'
+                +self.name
+                +'</h'+str(self.stars+1)+'>')
+
+    def placeholder(self, fragment):
+        '''Stand-in for self on a split page: just the heading.
+
+        The whole section is in the file fragment, and lazy_loader
+        swaps it in when it's needed.
+
+        '''
+        return '\n'.join([self.section_tag(' data-fragment="' + fragment + '"'),
+                          self.heading(),
+                          '</section>'])
+
+    def parts(self, modus):
+        strs = [self.section_tag()]
+        strs += [self.heading()]
+        strs += self.orphaned_contents
+        strs += self.sections
         strs += ['</section>']
-        return '\n'.join(strs)
+        return strs
 
     
 class Main(Section):
@@ -760,137 +1499,248 @@ class Main(Section):
             
     def __repr__(self):
         return self.accessible('mathml')
-    
-    def accessible(self, modus):
-        strs = ['<main role="main">',
+
+    def opening(self):
+        return ['<main role="main">',
                 '<header role="banner">',
                 '<h1>' + self.title + '</h1>',
                 '</header>']
-        strs += [c.accessible(modus) for c in self.sections]
-        strs += ['</main>']
-        return '\n'.join(strs)    
+    
+    def parts(self, modus):
+        return self.opening() + self.sections + ['</main>']
 
     
+class Site:
+    def __init__(self):
+        '''Cache of the files shared by the documents on a site.
+
+        However many documents (and modes) use them, each head/footer
+        file and each nav outline is only read once (unless it changes
+        while we're serving, see refresh()), and the nav block of each
+        note is only rendered once per modus.
+
+        '''
+        self.files = {}
+        self.outlines = {}
+        self.navs = {}
+        self.mtimes = {}
+
+    def refresh(self, filename):
+        '''Forget what we know about filename if it has been changed.
+
+        Only when serving: a single build doesn't last long enough to
+        care, but the service can run while you edit your files.
+
+        '''
+        if serve_root == None:
+            return
+        mtime = os.stat(filename).st_mtime_ns
+        if self.mtimes.get(filename) != mtime:
+            self.files.pop(filename, None)
+            self.outlines.pop(filename, None)
+            for key in list(self.navs):
+                if key[0] == filename:
+                    self.navs.pop(key, None)
+            self.mtimes[filename] = mtime
+
+    def read(self, filename):
+        '''Return the contents of filename.'''
+        self.refresh(filename)
+        # Another request's refresh() can empty the cache at any time,
+        # so hold on to what we found (or read) ourselves
+        contents = self.files.get(filename)
+        if contents == None:
+            with open(filename, "r") as external_info:
+                contents = external_info.read()
+            self.files[filename] = contents
+        return contents
+
+    def outline(self, filename):
+        '''Return the nav outline in filename as a dictionary:
+
+        - 'index' is the link to the index page,
+        - 'notes' is the list of note names, in order,
+        - 'titles' is {name: title},
+        - 'neighbours' is {name: (previous name, next name)}, with None
+          at either end.
+
+        '''
+        self.refresh(filename)
+        outline = self.outlines.get(filename) # see read()
+        if outline == None:
+            with open(filename, "r") as external_navfile:
+                content_list = yaml.load(external_navfile, Loader=yaml.FullLoader)
+
+            notes_list = [x for y in content_list['Notes'] for x in y.keys()]
+            notes_dict = {}
+            for x in content_list['Notes']:
+                notes_dict.update(x)
+            neighbours = {}
+            for k, name in enumerate(notes_list):
+                _prev = notes_list[k - 1] if k > 0 else None
+                _next = notes_list[k + 1] if k < len(notes_list) - 1 else None
+                neighbours[name] = (_prev, _next)
+
+            outline = {'index': content_list['Index'],
+                       'notes': notes_list,
+                       'titles': notes_dict,
+                       'neighbours': neighbours}
+            self.outlines[filename] = outline
+        return outline
+
+    def nav(self, filename, name, modus):
+        '''Return the nav block (a list of lines) for the note called name.'''
+        self.refresh(filename)
+        return_string = self.navs.get((filename, name, modus)) # see read()
+        if return_string == None:
+            outline = self.outline(filename)
+            index_link = outline['index']
+            notes_dict = outline['titles']
+            if name not in outline['neighbours']:
+                raise Exception(name + ' is not listed in ' + os.path.basename(filename))
+            _prev, _next = outline['neighbours'][name]
+            if modus == 'mathml':
+                previous_link = str(_prev) + '.html'
+                next_link = str(_next) + '.html'
+            elif modus == 'alt':
+                previous_link = str(_prev) + '_accessible.html'
+                next_link = str(_next) + '_accessible.html'
+            return_string = ['<nav role="navigation">', '<hr/>']
+            if _prev:
+                return_string += ['<a href="' + previous_link +'">Previous: ' + notes_dict[_prev] + '</a>']
+            return_string += ['<a href="' + index_link + '">| Index of lectures</a>']
+            if modus == 'mathml':
+                return_string += ['<a href="' + name + '_accessible.html">| Replace MathML by alt-text in this page |</a>']
+            elif modus == 'alt':
+                return_string += ['<a href="' + name + '.html">| Reinstate MathML in this page |</a>']
+
+            if _next:
+                return_string += ['<a href="' + next_link +'">Next:' + notes_dict[_next] + '</a>']
+            return_string += ['<hr/>', '</nav>']
+            self.navs[(filename, name, modus)] = return_string
+        return return_string
+
+site = Site()
+
+def site_path(filename):
+    '''Return the path of the file named by an @ command.
+
+    When serving, the text of each request chooses these files, so
+    they are looked up in serve_root and anything outside it is
+    refused.
+
+    '''
+    if serve_root == None:
+        return filename
+    path = os.path.realpath(os.path.join(serve_root, filename))
+    if os.path.commonpath([serve_root, path]) != serve_root:
+        raise Exception(filename + ' is not in the folder being served.')
+    return path
+
+
 class Document:
-    def __init__(self, filename, mode = '\\('):
+    def __init__(self, filename, mode = '\\(', cache_file = None, text = None):
+        '''Read and process filename.
+
+        If cache_file is given then the processed tree is stored
+        there, and on subsequent runs it is loaded from there instead
+        of re-parsing filename, provided neither filename, mode nor
+        lxl_version have changed in the meantime.
+
+        If text is given then it is processed instead of the contents
+        of filename (which is then only used to name the document).
+
+        '''
         self.mode = mode # '\(' or '$'
-        with open(filename) as f:
-            self.data = f.read()
-            
-        self.group_chars() # operates on self.data
-        self.add_gaps()    # operates on self.data
-        
-        self.lines = [Line(x, y)
-                      for x, y in zip(split_by_char(self.data, '\n'),
-                                      split_by_char(self.get_eq_map(), '\n'))]
-        
+        self.name = os.path.basename(filename)[:-4]
+        if text == None:
+            with open(filename) as f:
+                self.data = f.read()
+        else:
+            self.data = text
+        self.source_hash = text_hash(self.data)
+
+        if cache_file and self.load_cache(cache_file):
+            del self.data
+            for sct in self.main.sections:
+                schedule(sct)
+            return
+
+        self.lines = list(read_lines(io.StringIO(self.data), self.mode))
         self.run_commands()             # operates on self.lines
         self.create_list_environments() # operates on self.lines
 
         if not hasattr(self, 'title'):
             raise Exception("Accessible documents need a title. Use @ title in your input file.")
         self.main = Main(self.lines, self.title)
+        del self.data, self.lines # not needed after processing
 
-    def add_gaps(self):
-        shifted_data = self.data[1:] + [' ']
-        data_out = []
-        skip_next_char = 0
-        for x, y in zip(self.data, shifted_data):
-            if skip_next_char == 0:
-                if x == '\n' and y == '\n':
-                    data_out += [x, ' ', y]
-                    skip_next_char = 1
-                else:
-                    data_out += [x]
-            else:
-                skip_next_char = 0
+        if cache_file:
+            self.save_cache(cache_file)
 
-        self.data = data_out
-        
-    def group_chars(self):
-        '''Go through file and merge \(, $$, \$, etc into single characters.'''
-        shifted_data = self.data[1:] + ' '
-        data_out = []
-        skip_next_char = 0
-        for x, y in zip(self.data, shifted_data):
-            if skip_next_char == 0:
-                merge_test_1 = (x == '\\' and y in ['(', ')', '[', ']', '$'])
-                merge_test_2 = (x == '$' and y == '$')
-                if merge_test_1 or merge_test_2:
-                    data_out += [x + y]
-                    skip_next_char = 1
-                else:
-                    data_out += [x]
-            else:
-                skip_next_char = 0
+    def cache_key(self):
+        return (lxl_version, self.mode, self.source_hash)
 
-        self.data = data_out
+    def load_cache(self, cache_file):
+        '''Restore self from cache_file if it matches the current source.
 
-    def get_eq_map(self):
-        eq_map = []
-        in_eq = False
-        if self.mode == '\\(':
-            delimiters = ['\\[', '\\(', '\\]', '\\)', '$$']
-        elif self.mode == '$':
-            delimiters = ['\\[', '$', '\\]', '$$']
-        for char in self.data:
-            if char in delimiters:
-                eq_map += [True]
-                in_eq = not in_eq                    
-            elif char == '\n':
-                eq_map += ['\n']
-            else:
-                eq_map += [in_eq]
+        Returns True if successful; any unreadable, out of date or
+        missing cache is ignored (and overwritten later).
 
-        return eq_map
+        '''
+        try:
+            with open(cache_file, 'rb') as f:
+                # Check the key before unpickling a tree which may
+                # have been made by a different version of lxl.
+                if pickle.load(f) != self.cache_key():
+                    return False
+                state = pickle.load(f)
+        except (OSError, EOFError, AttributeError, TypeError, pickle.UnpicklingError):
+            return False
+        self.__dict__.update(state)
+        return True
+
+    def save_cache(self, cache_file):
+        '''Store the processed tree (and the @ commands) in cache_file.
+
+        pickle is recursive, so extremely deeply nested documents
+        can't be cached; they just get parsed every time.
+
+        '''
+        try:
+            data = (pickle.dumps(self.cache_key(), pickle.HIGHEST_PROTOCOL)
+                    + pickle.dumps(vars(self), pickle.HIGHEST_PROTOCOL))
+        except RecursionError:
+            return
+        with open(cache_file, 'wb') as f:
+            f.write(data)
 
+    def run_command(self, line):
+        '''If line is an @ command then apply it to self.
+
+        Returns True if line was a command (and so isn't part of the
+        text), False otherwise.
+
+        '''
+        if line.chars[0] != '@':
+            return False
+        line_text = split_by_char(line.chars, ' ')
+        command_name = ''.join(line_text[1])
+        arguments = ' '.join([''.join(l) for l in line_text[2:]])
+        if hasattr(self, command_name):
+            current = getattr(self, command_name)
+            setattr(self, command_name, ' '.join([current, arguments]))
+        else:
+            setattr(self, command_name, arguments)
+        return True
 
     def run_commands(self):
-        lines_to_remove = []
-        line_counter = 0
-        for line in self.lines:
-            if line.chars[0] == '@':
-                lines_to_remove += [line_counter]
-                line_text = split_by_char(line.chars, ' ')
-                command_name = ''.join(line_text[1])
-                arguments = ' '.join([''.join(l) for l in line_text[2:]])
-                if hasattr(self, command_name):
-                    current = getattr(self, command_name)
-                    setattr(self, command_name, ' '.join([current, arguments]))
-                else:
-                    setattr(self, command_name, arguments)
-            line_counter += 1
-            
-        self.lines = [self.lines[i]
-                      for i in range(0, len(self.lines))
-                      if i not in lines_to_remove]
+        self.lines = [line for line in self.lines
+                      if not self.run_command(line)]
         
     def create_list_environments(self):
-        new_lines = []
-        new_map = []
-        for line in self.lines:
-            i = line.indent
-            if i != None:
-                if line.chars[i] == '-' and line.char_map[i] == False:
-                    new_line_1 = line.chars[0:i] + ['#'] + [' '] + ['uli']
-                    new_map_1 = [False for k in range(0, i+3)]
-                    new_line_2 = line.chars[0:i] + [' '] + [' '] + line.chars[i + 2:]
-                    new_map_2 = [False for k in range(0, i+2)] + line.char_map[i + 2:]
-                    new_lines += [Line(new_line_1, new_map_1),
-                                  Line(new_line_2, new_map_2)]
-                elif line.chars[i] == '+' and line.char_map[i] == False:
-                    new_line_1 = line.chars[0:i] + ['#'] + [' '] + ['oli']
-                    new_map_1 = [False for k in range(0, i+3)]
-                    new_line_2 = line.chars[0:i] + [' '] + [' '] + line.chars[i + 2:]
-                    new_map_2 = [False for k in range(0, i+2)] + line.char_map[i + 2:]
-                    new_lines += [Line(new_line_1, new_map_1),
-                                  Line(new_line_2, new_map_2)]
-                else:
-                    new_lines += [line]
-            else:
-                new_lines += [line]
-
-        self.lines = new_lines
+        self.lines = [new_line for line in self.lines
+                      for new_line in line.listify()]
 
     def get_meta(self, tag):
         if tag == 'title':
@@ -911,54 +1761,13 @@ class Document:
 
     def get_external(self, what_to_get):
         if hasattr(self, what_to_get):
-            external_filename = getattr(self, what_to_get)
-            with open(external_filename, "r") as external_info:
-                data = external_info.read()
-
-            return [data]
+            return [site.read(site_path(getattr(self, what_to_get)))]
         else:
             return []
 
     def get_nav(self, modus):
         if hasattr(self, 'nav'):
-            external_filename = self.nav
-            with open(external_filename, "r") as external_navfile:
-                content_list = yaml.load(external_navfile, Loader=yaml.FullLoader)
-
-            index_link = content_list['Index']
-            notes_list = [x for y in content_list['Notes'] for x in y.keys()]
-            notes_dict = {}
-            for x in content_list['Notes']:
-                notes_dict.update(x)
-                
-            current_node = notes_list.index(input_file[:-4])
-            if current_node == 0:
-                _prev = None
-            else:
-                _prev = notes_list[current_node - 1]
-            if current_node == len(notes_list) - 1:
-                _next = None
-            else:
-                _next = notes_list[current_node + 1]
-            if modus == 'mathml':
-                previous_link = str(_prev) + '.html'
-                next_link = str(_next) + '.html'
-            elif modus == 'alt':
-                previous_link = str(_prev) + '_accessible.html'
-                next_link = str(_next) + '_accessible.html'
-            return_string = ['<nav role="navigation">', '<hr/>']
-            if _prev:
-                return_string += ['<a href="' + previous_link +'">Previous: ' + notes_dict[_prev] + '</a>']
-            return_string += ['<a href="' + index_link + '">| Index of lectures</a>']
-            if modus == 'mathml':
-                return_string += ['<a href="' + output_accessible +'">| Replace MathML by alt-text in this page |</a>']
-            elif modus == 'alt':
-                return_string += ['<a href="' + output_mathml +'">| Reinstate MathML in this page |</a>']
-
-            if _next:
-                return_string += ['<a href="' + next_link +'">Next:' + notes_dict[_next] + '</a>']
-            return_string += ['<hr/>', '</nav>']
-            return return_string
+            return site.nav(site_path(self.nav), self.name, modus)
         else:
             return []
                 
@@ -968,7 +1777,8 @@ class Document:
     def __repr__(self):
         return self.accessible('mathml')
 
-    def accessible(self, modus):
+    def opening(self, modus):
+        '''Everything in the page up to the start of the main text.'''
         strs = ['<!DOCTYPE html>',
                 '<html lang="en">',
                 '<head>']
@@ -977,21 +1787,471 @@ class Document:
         strs += self.get_external('headcontent')
         strs += ['</head>', '<body>']
         strs += self.get_nav(modus)
+        return strs
+
+    def closing(self):
+        '''Everything in the page after the end of the main text.'''
+        return self.get_external('footer') + ['</body>', '</html>']
+
+    def accessible(self, modus):
+        strs = self.opening(modus)
         #etc
         strs += [self.main.accessible(modus)]
         #etc
-        strs += self.get_external('footer')
-        strs += ['</body>', '</html>']
+        strs += self.closing()
         return '\n'.join(strs)
-        
+
+    def search_terms(self):
+        '''Return the search terms of self as {term: set of section idnums}.'''
+        terms = {}
+        for sct in self.main.sections:
+            section_terms(sct, terms)
+        return terms
+
+    def labels(self):
+        '''Return the labels in self as {label: [section idnum, display name]}.'''
+        labels = {}
+        for sct in self.main.sections:
+            section_labels(sct, labels)
+        return labels
+
+    def write_terms(self, filename):
+        '''Save the search terms of self in filename for build_search_index().'''
+        terms = {term: sorted(idnums) for term, idnums in self.search_terms().items()}
+        with open(filename, "w") as f:
+            json.dump(terms, f, separators = (',', ':'))
+
+    def sections(self):
+        '''The top-level Sections of self.'''
+        return self.main.sections
+
+    def write(self, outputs, minified = False, split = False):
+        '''Write the page for each modus to a file, a section at a time.
+
+        outputs is a dictionary of the form {modus: filename}.
+
+        If minified is True everything is run through minify().
+
+        If split is True then only the first top-level section goes
+        in the page itself. The others just get their headings there,
+        and the rest of each one is written to its own file (e.g.
+        notes_part2.html), which lazy_loader fetches when the reader
+        scrolls down to it or follows a link into it.
+
+        Returns a list of all the files written.
+
+        '''
+        outs = {modus: open(filename, "w") for modus, filename in outputs.items()}
+        written = list(outputs.values())
+        def put(out, text):
+            if minified:
+                text = minify(text)
+            out.write(text)
+
+        for modus, out in outs.items():
+            put(out, '\n'.join(self.opening(modus) + self.main.opening()))
+        for number, section in enumerate(self.sections()):
+            for modus, out in outs.items():
+                if split and number > 0:
+                    fragment = outputs[modus][:-5] + '_part' + str(number + 1) + '.html'
+                    with open(fragment, "w") as f:
+                        put(f, section.accessible(modus))
+                    written += [fragment]
+                    put(out, '\n' + section.placeholder(os.path.basename(fragment)))
+                else:
+                    put(out, '\n' + section.accessible(modus))
+        for modus, out in outs.items():
+            strs = ['</main>']
+            if split:
+                strs += [lazy_loader]
+            put(out, '\n' + '\n'.join(strs + self.closing()))
+            out.close()
+        return written
+
+
+class StreamingDocument(Document):
+    def __init__(self, filename, mode = '\\(', keep_terms = False, keep_labels = False):
+        '''A Document which is processed one top-level section at a time.
+
+        Document reads the whole of filename and builds the whole
+        tree before anything gets written. Instead, a
+        StreamingDocument reads filename line by line and each
+        top-level Section is processed and written out as soon as the
+        next one starts, so only one section is ever in memory. This
+        is for very large files, e.g. compiled textbooks.
+
+        The price is that all @ commands must come before the first
+        section (because by then we need to know the title etc).
+
+        The sections are gone by the time we'd want their search terms
+        or labels, so if keep_terms (keep_labels) is True they're noted
+        down as we go (which costs another pass over the document).
+
+        '''
+        self.mode = mode # '\(' or '$'
+        self.name = os.path.basename(filename)[:-4]
+        self.filename = filename
+        self.keep_terms = keep_terms
+        self.keep_labels = keep_labels
+
+        # Run the @ commands straight away, so we know about nav etc
+        # before anything gets written.
+        with open(self.filename) as f:
+            for line in read_lines(f, self.mode):
+                if line.stars():
+                    break
+                self.run_command(line)
+
+        if not hasattr(self, 'title'):
+            raise Exception("Accessible documents need a title. Use @ title in your input file.")
+        self.main = Main([], self.title)
+
+    def sections(self):
+        '''Generate the processed top-level Sections of self.filename.
+
+        A top-level section ends at the first heading which is no
+        deeper than it, just as in Main.sectionise(), but we don't
+        hold on to the sections. Their search terms and labels are
+        noted down as we go, if self.keep_terms and self.keep_labels.
+
+        '''
+        self.terms = {}
+        self.labelled = {}
+        section = None
+        with open(self.filename) as f:
+            for line in read_lines(f, self.mode):
+                if line.chars[0] == '@':
+                    # Already run by __init__
+                    if section:
+                        raise Exception("When streaming, all @ commands must come before the first section.")
+                    continue
+                for new_line in line.listify():
+                    if section == None:
+                        if new_line.stars():
+                            section = Section(new_line)
+                        # otherwise it's orphaned content, which
+                        # Main ignores too
+                    elif 0 < new_line.stars() <= section.stars:
+                        yield self.finish(section)
+                        section = Section(new_line)
+                    else:
+                        section.contents += [new_line]
+        if section:
+            yield self.finish(section)
+
+    def finish(self, section):
+        '''Process section, which is now complete.'''
+        section.process()
+        if self.keep_terms:
+            section_terms(section, self.terms)
+        if self.keep_labels:
+            section_labels(section, self.labelled)
+        return section
+
+    def search_terms(self):
+        '''Return the search terms collected by self.write().'''
+        return self.terms
+
+    def labels(self):
+        '''Return the labels collected by self.write().'''
+        return self.labelled
+
+
+class LabelIndex:
+    def __init__(self, outline_file, current):
+        '''Index of the labels of all the notes listed in outline_file.
+
+        Environments like "# Theorem thm:gauss Gauss's Theorem" are
+        labelled, and \\ref{thm:gauss} anywhere on the site becomes a
+        link to them. self.labels maps each label to [document name,
+        section idnum, display name].
+
+        The index is saved in label_file next to outline_file, along
+        with the hash of each document's source (so that only changed
+        documents are re-read) and how each document's references
+        were resolved when it was last built (so we can tell which
+        documents need rebuilding when labels change).
+
+        current is the name of the document being built.
+
+        '''
+        self.outline_file = outline_file
+        self.filename = os.path.join(os.path.dirname(outline_file), label_file)
+        self.current = current
+        try:
+            with open(self.filename, "r") as f:
+                self.docs = json.load(f)
+        except (OSError, ValueError):
+            self.docs = {}
+        self.labels = {}
+        self.refs = {} # how the references in the current document were resolved
+
+    def update(self, skip = ()):
+        '''Re-read any documents in the outline which have changed.
+
+        Documents are parsed using their .lxlc caches, so this is
+        cheap. Documents named in skip are left as they are (add them
+        with self.add()).
+
+        '''
+        folder = os.path.dirname(self.outline_file)
+        names = site.outline(self.outline_file)['notes']
+
+        for name in list(self.docs):
+            if name not in names:
+                del self.docs[name]
+        for name in names:
+            if name in skip:
+                continue
+            source = os.path.join(folder, name + '.lxl')
+            if not os.path.exists(source):
+                self.docs.pop(name, None)
+                continue
+            with open(source) as f:
+                source_hash = text_hash(f.read())
+            if name in self.docs and self.docs[name]['source'] == source_hash:
+                continue
+            with unscheduled():
+                # We only want its labels, not its MathML
+                document = Document(source, cache_file = os.path.join(folder, name + '.lxlc'))
+            self.add(name, document)
+
+        self.find_labels()
+
+    def add(self, name, document):
+        '''Record the labels of document, which is called name.'''
+        refs = self.docs.get(name, {}).get('refs', {})
+        self.docs[name] = {'source': getattr(document, 'source_hash', None),
+                           'labels': document.labels(),
+                           'refs': refs}
+        self.find_labels()
+
+    def find_labels(self):
+        self.labels = {label: [name] + target
+                       for name, doc in self.docs.items()
+                       for label, target in doc['labels'].items()}
+
+    def link_target(self, label):
+        '''The parts of the entry for label which go into a link to it.'''
+        if label in self.labels:
+            name, idnum, display = self.labels[label]
+            return [name, display]
+
+    def link(self, label, modus):
+        '''Return a link to label from the current document.'''
+        self.refs[label] = self.link_target(label)
+        if label not in self.labels:
+            return '??'
+        name, idnum, display = self.labels[label]
+        if name == self.current:
+            page = ''
+        elif modus == 'alt':
+            page = name + '_accessible.html'
+        else:
+            page = name + '.html'
+        return '<a href="' + page + '#' + label + '">' + display + '</a>'
+
+    def stale(self):
+        '''Names of documents whose references have changed since they were built.
+
+        Use this after self.save().
+        '''
+        return [name for name, doc in self.docs.items()
+                if any(self.link_target(label) != target
+                       for label, target in doc['refs'].items())]
+
+    def save(self):
+        if self.current in self.docs:
+            self.docs[self.current]['refs'] = self.refs
+        with open(self.filename, "w") as f:
+            json.dump(self.docs, f, separators = (',', ':'))
+
+
+class Metrics:
+    def __init__(self):
+        '''Running totals for the rendering service.'''
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.active = 0
+        self.latencies = collections.deque(maxlen = 1000) # seconds, most recent requests
+
+    def start(self):
+        with self.lock:
+            self.active += 1
+        return time.perf_counter()
+
+    def finish(self, started, ok):
+        with self.lock:
+            self.active -= 1
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+            self.latencies.append(time.perf_counter() - started)
+
+    def report(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            report = {'requests': self.requests,
+                      'errors': self.errors,
+                      'active': self.active}
+        if latencies:
+            report['latency_ms'] = {'mean': 1000 * sum(latencies) / len(latencies),
+                                    'p50': 1000 * latencies[len(latencies) // 2],
+                                    'p95': 1000 * latencies[int(len(latencies) * 0.95)],
+                                    'max': 1000 * latencies[-1]}
+        if pipeline:
+            with pipeline.lock:
+                lookups = pipeline.hits + pipeline.misses
+                report['cache'] = {'hits': pipeline.hits,
+                                   'misses': pipeline.misses,
+                                   'hit_rate': pipeline.hits / lookups if lookups else None,
+                                   'size': len(pipeline.jobs)}
+        return report
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    '''Requests for the rendering service:
+
+    - POST /render with JSON {"text": the text of an .lxl file}
+      returns JSON {"mathml": page with MathML, "accessible": page
+      with alt text}. Add "mode": "$" if the file uses $ for
+      equations, and "name": the file name without .lxl if it uses
+      @ nav. The Content-Type must be application/json: web pages
+      can't send that to another site without asking first (which
+      we never allow), so they can't use the service behind your
+      back.
+
+    - GET /metrics returns JSON with request counts, latencies and
+      how often equations were found in the cache.
+
+    '''
+    def do_GET(self):
+        if urlparse(self.path).path == '/metrics':
+            self.reply(200, self.server.metrics.report())
+        else:
+            self.reply(404, {'error': 'Try POST /render or GET /metrics'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/render':
+            self.reply(404, {'error': 'Try POST /render or GET /metrics'})
+            return
+        if self.headers.get('Content-Type', '').split(';')[0].strip() != 'application/json':
+            self.reply(415, {'error': 'Send the text as JSON {"text": ...}'})
+            return
+        started = self.server.metrics.start()
+        ok = False
+        # Images are built in a folder of their own, thrown away afterwards
+        rendering.folder = tempfile.mkdtemp(prefix = 'lxl-')
+        try:
+            os.makedirs(os.path.join(rendering.folder, img_path))
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('UTF-8'))
+            mode = data.get('mode', '\\(')
+            name = data.get('name', 'preview')
+            if mode not in ['\\(', '$']:
+                raise Exception('mode should be \\( or $')
+            if not re.fullmatch(r'[\w-]+', name):
+                raise Exception('name should be a file name without .lxl')
+            document = Document(name + '.lxl', mode, text = data['text'])
+            pages = {'mathml': document.accessible('mathml'),
+                     'accessible': document.accessible('alt')}
+            ok = True
+        except Exception as error:
+            pages = {'error': str(error)}
+        finally:
+            shutil.rmtree(rendering.folder, ignore_errors = True)
+            rendering.folder = None
+        self.server.metrics.finish(started, ok)
+        self.reply(200 if ok else 400, pages)
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RenderServer(HTTPServer):
+    def __init__(self, port, workers):
+        '''Local rendering service (see RenderHandler).
+
+        Requests are handled by a pool of workers threads, so at most
+        workers documents are rendered at once. Equations are
+        converted by the Pipeline, which stays up between requests and
+        remembers every equation it has converted.
+
+        '''
+        super().__init__(('127.0.0.1', port), RenderHandler)
+        self.pool = ThreadPoolExecutor(workers)
+        self.metrics = Metrics()
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
 if __name__ == '__main__':
-    c = Document(input_file)
-    out_1 = open(output_mathml, "w")
-    out_2 = open(output_accessible, "w")
-    out_1.write(c.accessible('mathml'))
-    out_2.write(c.accessible('alt'))
-    out_1.close()
-    out_2.close()
+    image_format = args.images
+    image_resolution = args.dpi
+    image_scaling = args.scale_images
+    if input_file == 'serve':
+        pipeline = Pipeline(tool_limits, job_limit)
+    elif args.parallel:
+        pipeline = Pipeline(tool_limits, keep = False)
+    if input_file == 'serve':
+        serve_root = os.path.realpath(args.root)
+        # Requests can contain tikzpictures, so don't let TeX read or
+        # write files outside the folder it runs in, or run programs
+        os.environ.update({'openin_any': 'p', 'openout_any': 'p', 'shell_escape': 'f'})
+        print('Serving on http://127.0.0.1:' + str(args.port) + '/render')
+        try:
+            RenderServer(args.port, args.workers).serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        if args.stream:
+            c = StreamingDocument(input_file, keep_terms = args.index, keep_labels = args.labels)
+        else:
+            c = Document(input_file, cache_file = output_cache)
+        if args.labels:
+            if not hasattr(c, 'nav'):
+                raise Exception("Labels are looked up in the notes in your outline. Use @ nav in your input file.")
+            label_index = LabelIndex(c.nav, c.name)
+            label_index.update(skip = [label_index.current])
+            if not args.stream:
+                # A StreamingDocument only finds its labels as it's written
+                label_index.add(label_index.current, c)
+        written = c.write({'mathml': output_mathml, 'alt': output_accessible},
+                          minified = args.minify, split = args.split)
+        if args.labels:
+            if args.stream:
+                label_index.add(label_index.current, c)
+            label_index.save()
+            for name in label_index.stale():
+                print('References to changed labels, please rebuild ' + name + '.lxl')
+        compressible = written
+        if args.index:
+            if not hasattr(c, 'nav'):
+                raise Exception("The search index covers the notes in your outline. Use @ nav in your input file.")
+            c.write_terms(output_terms)
+            compressible += build_search_index(c.nav)
+        if args.compress:
+            compress_all(compressible)
+        else:
+            remove_compressed(compressible)
+    if pipeline:
+        pipeline.close()
 
 
 
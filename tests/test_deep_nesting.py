@@ -0,0 +1,60 @@
+'''Check that very deeply nested documents still build.
+
+The document tree is walked and serialised with explicit stacks, not
+recursion, so nesting deeper than Python's recursion limit (1000)
+should be fine. This builds a list and a stack of environments each
+nested depth deep and runs lxl.py on them.
+
+Run with python tests/test_deep_nesting.py (or pytest).
+
+'''
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+lxl = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lxl.py')
+depth = 5001
+
+def deep_list(depth):
+    '''depth nested unordered lists, one item each.'''
+    lines = ['@ title Deep list', '* Deep']
+    lines += ['  ' * k + '- level ' + str(k) for k in range(depth)]
+    return '\n'.join(lines) + '\n'
+
+def deep_environments(depth):
+    '''depth nested Remark environments with some text in the middle.'''
+    lines = ['@ title Deep environments', '* Deep']
+    lines += [' ' * k + '# Remark' for k in range(depth)]
+    lines += [' ' * depth + 'inner']
+    return '\n'.join(lines) + '\n'
+
+def build(text):
+    '''Run lxl.py on text and return (the MathML page, the alt text page).'''
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'deep.lxl'), 'w') as f:
+            f.write(text)
+        subprocess.run([sys.executable, lxl, 'deep.lxl'], cwd = folder, check = True,
+                       stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        pages = []
+        for name in ['deep.html', 'deep_accessible.html']:
+            with open(os.path.join(folder, name)) as f:
+                pages += [f.read()]
+        return pages
+
+class DeepNesting(unittest.TestCase):
+    def test_deep_list(self):
+        for page in build(deep_list(depth)):
+            self.assertEqual(page.count('<ul>'), depth)
+            self.assertEqual(page.count('</ul>'), depth)
+            self.assertIn('level ' + str(depth - 1), page)
+
+    def test_deep_environments(self):
+        for page in build(deep_environments(depth)):
+            self.assertEqual(page.count('<figure class="Remark">'), depth)
+            self.assertEqual(page.count('</figure>'), depth)
+            self.assertIn('inner', page)
+
+if __name__ == '__main__':
+    unittest.main()